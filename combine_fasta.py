@@ -1,11 +1,64 @@
 #!/usr/bin/env python
 import argparse
+import itertools
+from array import array
 import fastalite
 import logging
+from operator import attrgetter
+from fastatools_io import CachedRecord, OutputWriter, read_fasta, seq_key, seq_key_for
 
 # As the name implies, given a set of fasta / fastq files (min 2), combine them into one fasta file.
 #  Check at least to be sure no overlapping IDs. Optionally check sequences themselves.
 #  Optionally handle paired reads (being sure to include each pair)
+#  Optionally dereplicate: collapse identical sequences, annotating each kept one with ;size=N
+
+
+def combine_records(records, check_seq=False, key=None):
+    # Streaming core: yield records, leaving out repeated IDs (and optionally repeated sequences).
+    #  key(sr) is what sequences are compared by, sr.seq by default
+    if key is None:
+        key = attrgetter('seq')
+    seq_ids = set()
+    seqs = set()
+    for sr in records:
+        if sr.id in seq_ids:
+            continue
+        if check_seq:
+            seq = key(sr)
+            if seq in seqs:
+                continue
+            seqs.add(seq)
+        seq_ids.add(sr.id)
+        yield sr
+
+
+def dereplicate(records, member_h=None, sort_by_size=False):
+    #   Collapse identical sequences. Returns a list of (representative, size), the
+    #   representative being the first record seen with each sequence. Sequences are
+    #   held packed and only the count is kept per unique sequence. Optionally writes
+    #   member_id <tab> representative_id to member_h for every record.
+    rep_n = {}
+    reps = []
+    sizes = array('L')
+    for sr in records:
+        key = seq_key(sr)
+        n = rep_n.get(key)
+        if n is None:
+            n = len(reps)
+            rep_n[key] = n
+            reps.append(CachedRecord(sr.description, key))
+            sizes.append(1)
+        else:
+            sizes[n] += 1
+        if member_h is not None:
+            member_h.write("%s\t%s\n" % (sr.id, reps[n].id))
+    del rep_n
+    logging.info("{:,} unique sequences from {:,} records".format(len(reps), sum(sizes)))
+    derep = list(zip(reps, sizes))
+    if sort_by_size:
+        # Stable, so equal sizes stay in the order first seen
+        derep.sort(key=lambda rep: rep[1], reverse=True)
+    return derep
 
 
 def main():
@@ -33,12 +86,33 @@ def main():
         help='Also check to be sure sequences are not repeated. Default is to only check for repeated IDs',
         action='store_true'
     )
+    args_parser.add_argument(
+        '--derep',
+        '-d',
+        help="""Dereplicate: write each distinct sequence once, from its first record,
+        with the number of records sharing it appended to the ID as ;size=N""",
+        action='store_true'
+    )
+    args_parser.add_argument(
+        '--sort-size',
+        help='With --derep, write sequences from most to least abundant',
+        action='store_true'
+    )
+    args_parser.add_argument(
+        '--derep-map',
+        help='With --derep, also write a TSV of each record ID and the ID of its representative',
+        type=fastalite.Opener(mode='w')
+    )
     args_parser.add_argument(
         '--output',
         '-o',
         help='File into which we should place our combined reads',
         required=True,
-        type=fastalite.Opener(mode='w')
+    )
+    args_parser.add_argument(
+        '--sidecar',
+        help='Also write record / base counts and md5 / sha256 of the output to <output>.stats.json',
+        action='store_true'
     )
 
     args = args_parser.parse_args()
@@ -48,49 +122,39 @@ def main():
         logging.error("Only one file given. Nothing to do.")
         return -1
 
-    out_h = args.output
+    if args.derep and args.fastq:
+        args_parser.error("--derep writes fasta, so cannot be used with --fastq")
+    if (args.sort_size or args.derep_map is not None) and not args.derep:
+        args_parser.error("--sort-size and --derep-map need --derep")
 
-    if args.check_seq:
-        seq_ids = set()
-        seqs = set()
-        for file_h in args.files:
-            if args.fastq:
-                reader = fastalite.fastqlite(file_h)
-            else:
-                reader = fastalite.fastalite(file_h)
-            for sr in reader:
-                if sr.id not in seq_ids and sr.seq not in seqs:
-                    seq_ids.add(sr.id)
-                    seqs.add(sr.seq)
-                    if args.fastq:
-                        out_h.write("@{} {}\n{}\n+\n{}\n".format(
-                            sr.id,
-                            sr.description,
-                            sr.seq,
-                            sr.qual
-                        ))
-                    else:
-                        out_h.write(">%s %s\n%s\n" % (sr.id, sr.description, sr.seq))
-
-    else:  # just IDs
-        seq_ids = set()
-        for file_h in args.files:
+    if args.fastq:
+        records = itertools.chain.from_iterable(fastalite.fastqlite(file_h) for file_h in args.files)
+    else:
+        records = itertools.chain.from_iterable(read_fasta(file_h) for file_h in args.files)
+
+    with OutputWriter(args.output, 'fastq' if args.fastq else 'fasta', sidecar=args.sidecar) as out_h:
+        if args.derep:
+            # Repeated IDs are still left out, so each record is counted once
+            derep = dereplicate(
+                combine_records(records),
+                member_h=args.derep_map,
+                sort_by_size=args.sort_size
+            )
+            if args.derep_map is not None:
+                args.derep_map.close()
+            for sr, size in derep:
+                seq = sr.seq
+                out_h.write(">%s;size=%d %s\n%s\n" % (sr.id, size, sr.description, seq))
+                out_h.count_record(len(seq))
+            return
+
+        key = None if args.fastq else seq_key_for(args.files)
+        for sr in combine_records(records, check_seq=args.check_seq, key=key):
             if args.fastq:
-                reader = fastalite.fastqlite(file_h)
+                out_h.write_fastq(sr)
             else:
-                reader = fastalite.fastalite(file_h)
-            for sr in reader:
-                if sr.id not in seq_ids:
-                    seq_ids.add(sr.id)
-                    if args.fastq:
-                        out_h.write("@{} {}\n{}\n+\n{}\n".format(
-                            sr.id,
-                            sr.description,
-                            sr.seq,
-                            sr.qual
-                        ))
-                    else:
-                        out_h.write(">%s %s\n%s\n" % (sr.id, sr.description, sr.seq))
+                out_h.write_fasta(sr)
+
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,18 @@
 #!/usr/bin/env python
 import argparse
+import csv
 import logging
+import multiprocessing
+import os
+import queue
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import namedtuple, OrderedDict
+from itertools import chain
 import fastalite
+from fastatools_io import OutputWriter, SIDECAR_SUFFIX
 
 #
 #   Given at least set(s) of paired reads in fastq format,
@@ -10,6 +21,20 @@ import fastalite
 #       Pairs should be in order
 #       Reads should be in order.
 #
+#   With --pipeline, parsing R1, parsing R2, pairing and writing each output
+#   run as separate processes connected by bounded queues of record batches.
+#
+#   With --window, pairs only need to be nearly in order: unmatched reads wait
+#   in a bounded buffer per side until their mate shows up, in a single pass.
+#
+#   With --manifest, many samples (one per row of a TSV) are merged
+#   on a local pool of processes, each with its own log.
+#
+
+# Picklable stand-in for the fastalite records, which cannot cross processes
+FastqRecord = namedtuple('FastqRecord', ['id', 'description', 'seq', 'qual'])
+# Sent to a write stage in place of a batch when the run has failed
+ABORT_WRITE = 'abort'
 
 
 def get_seq_id(raw_id, normalize=True):
@@ -19,73 +44,243 @@ def get_seq_id(raw_id, normalize=True):
         return raw_id
 
 
-def write_fastq(sr, out_h):
-    out_h.write("@{} {}\n{}\n+\n{}\n".format(
-        sr.id,
-        sr.description,
-        sr.seq,
-        sr.qual
-    ))
+def iter_fastq(fastq_h):
+    # fastqlite raises ValueError on a malformed record, which also ends its generator,
+    # so the file ends there
+    reader = fastalite.fastqlite(fastq_h)
+    while True:
+        try:
+            yield next(reader)
+        except (ValueError, StopIteration):
+            return
 
 
-def main():
-    args_parser = argparse.ArgumentParser(
-        description="""Given set(s) of paired reads in fastq format
-        combine all into one pair of reads also in fastq format.
-        Concurrently confirm all R1 have matched R2.
-        """
-    )
+def handle_path(h):
+    # The pipeline stages reopen files by name in their own process
+    path = getattr(h, 'name', None)
+    if not isinstance(path, str) or path.startswith('<'):
+        raise ValueError("--pipeline requires named files, not {}".format(path))
+    return path
 
-    args_parser.add_argument(
-        '--in-1',
-        '-1',
-        help='Read 1 Files to be combined.',
-        nargs='+',
-        required=True,
-        type=fastalite.Opener(mode='r')
-    )
-    args_parser.add_argument(
-        '--in-2',
-        '-2',
-        help="""Read 2 Files to be combined. Must be in same order as --in-1""",
-        nargs='+',
-        required=True,
-        type=fastalite.Opener(mode='r')
-    )
 
-    args_parser.add_argument(
-        '--out-1',
-        '-o1',
-        help='File into which we should place our combined R1',
-        required=True,
-        type=fastalite.Opener(mode='w')
-    )
-    args_parser.add_argument(
-        '--out-2',
-        '-o2',
-        help='File into which we should place our combined R2',
-        required=True,
-        type=fastalite.Opener(mode='w')
-    )
+def get_message(in_q, proc):
+    # Block on a stage queue, but give up if the stage feeding it has died
+    while True:
+        try:
+            message = in_q.get(timeout=1)
+        except queue.Empty:
+            if not proc.is_alive():
+                raise RuntimeError("{} stage exited unexpectedly".format(proc.name))
+            continue
+        if message[0] == 'error':
+            raise RuntimeError("{} stage failed: {}".format(proc.name, message[1]))
+        return message
 
-    args_parser.add_argument(
-        '--normalize-ids',
-        '-ni',
-        help='Normalize IDs for pairs by stripping /x from the end',
-        action='store_true'
-    )
 
-    args = args_parser.parse_args()
-    logging.basicConfig(level=logging.INFO)
+def put_message(out_q, message, proc):
+    # Block on a full stage queue, but give up if the stage draining it has died
+    while True:
+        try:
+            out_q.put(message, timeout=1)
+            return
+        except queue.Full:
+            if not proc.is_alive():
+                raise RuntimeError("{} stage exited unexpectedly".format(proc.name))
+
+
+def parse_stage(paths, normalize, out_q, batch_size):
+    #   Pipeline stage: first send the (normalized) IDs of each file in batches,
+    #   followed by an ids_eof marker per file, then stream each file as batches
+    #   of (normalized id, record), followed by an eof marker per file.
+    opener = fastalite.Opener(mode='r')
+    try:
+        for path in paths:
+            with opener(path) as fastq_h:
+                batch = []
+                for sr in iter_fastq(fastq_h):
+                    batch.append(get_seq_id(sr.id, normalize))
+                    if len(batch) >= batch_size:
+                        out_q.put(('ids', batch))
+                        batch = []
+                if batch:
+                    out_q.put(('ids', batch))
+            out_q.put(('ids_eof', None))
+        for path in paths:
+            with opener(path) as fastq_h:
+                batch = []
+                for sr in iter_fastq(fastq_h):
+                    batch.append((get_seq_id(sr.id, normalize), FastqRecord(*sr)))
+                    if len(batch) >= batch_size:
+                        out_q.put(('batch', batch))
+                        batch = []
+                if batch:
+                    out_q.put(('batch', batch))
+            out_q.put(('eof', None))
+    except Exception as e:
+        out_q.put(('error', repr(e)))
+
+
+def write_stage(path, in_q, sidecar):
+    #   Pipeline stage: format and (optionally) compress batches of records until None,
+    #   or until ABORT_WRITE, which closes the output without a sidecar
+    with OutputWriter(path, 'fastq', sidecar=sidecar) as out_h:
+        while True:
+            batch = in_q.get()
+            if batch is None:
+                break
+            if batch == ABORT_WRITE:
+                out_h.abort()
+                break
+            for sr in batch:
+                out_h.write_fastq(sr)
+
+
+def stage_ids(in_q, proc):
+    # Collect the set of (normalized) IDs of one file from a parse stage
+    file_ids = set()
+    while True:
+        kind, payload = get_message(in_q, proc)
+        if kind == 'ids_eof':
+            return file_ids
+        file_ids.update(payload)
+
+
+def stage_records(in_q, proc):
+    # Yield the (normalized id, record) pairs of one file from a parse stage
+    while True:
+        kind, payload = get_message(in_q, proc)
+        if kind == 'eof':
+            return
+        for rec in payload:
+            yield rec
+
+
+def run_pipeline(r1_paths, r2_paths, out_1_path, out_2_path, normalize, batch_size=1000, queue_depth=8,
+                 sidecar=False):
+    q_in_1 = multiprocessing.Queue(queue_depth)
+    q_in_2 = multiprocessing.Queue(queue_depth)
+    q_out_1 = multiprocessing.Queue(queue_depth)
+    q_out_2 = multiprocessing.Queue(queue_depth)
+    p_in_1 = multiprocessing.Process(
+        target=parse_stage, args=(r1_paths, normalize, q_in_1, batch_size), name='R1 parse')
+    p_in_2 = multiprocessing.Process(
+        target=parse_stage, args=(r2_paths, normalize, q_in_2, batch_size), name='R2 parse')
+    p_out_1 = multiprocessing.Process(target=write_stage, args=(out_1_path, q_out_1, sidecar), name='R1 write')
+    p_out_2 = multiprocessing.Process(target=write_stage, args=(out_2_path, q_out_2, sidecar), name='R2 write')
+    procs = [p_in_1, p_in_2, p_out_1, p_out_2]
+    for p in procs:
+        p.start()
+
+    try:
+        # Same duplicate reporting as the serial path, from the IDs sent by the parse stages
+        IDs_R1 = set()
+        IDs_R2 = set()
+        logging.info("Looping through files to identify all sequence IDs")
+        for _ in r1_paths:
+            file_ids_r1 = stage_ids(q_in_1, p_in_1)
+            file_ids_r2 = stage_ids(q_in_2, p_in_2)
+            if len(IDs_R1.intersection(file_ids_r1)) > 0:
+                logging.warning("{:,} of {:,} R1 read IDs from this file overlap with others".format(
+                    len(IDs_R1.intersection(file_ids_r1)),
+                    len(file_ids_r1)
+                ))
+            if len(IDs_R2.intersection(file_ids_r2)) > 0:
+                logging.warning("{:,} of {:,} R2 read IDs from this file overlap with others".format(
+                    len(IDs_R2.intersection(file_ids_r2)),
+                    len(file_ids_r2)
+                ))
+            IDs_R1.update(file_ids_r1)
+            IDs_R2.update(file_ids_r2)
+
+        overlapped_ids = IDs_R1.intersection(IDs_R2)
+        starting_num_ids = len(overlapped_ids)
+        logging.info("There are {:,} overlapping IDs from {:,} forward read IDs and {:,} reverse read IDs".format(
+            starting_num_ids,
+            len(IDs_R1),
+            len(IDs_R2)
+        ))
+        del IDs_R1, IDs_R2
+
+        pairs_written = 0
+        out_batch_1 = []
+        out_batch_2 = []
+        for _ in r1_paths:
+            srs_r1 = stage_records(q_in_1, p_in_1)
+            srs_r2 = stage_records(q_in_2, p_in_2)
+            for seq_id, sr_1 in srs_r1:
+                if len(overlapped_ids) == 0:
+                    break
+                if seq_id not in overlapped_ids:
+                    continue
+                for seq_id_2, sr_2 in srs_r2:
+                    if seq_id_2 in overlapped_ids:
+                        break
+                else:  # Out of R2 for this file
+                    break
+                assert seq_id == seq_id_2, "Order off of reads"
+                if len(overlapped_ids) % 10000 == 0:
+                    logging.info(
+                        "{:,} of {:,} pairs remaining".format(
+                            len(overlapped_ids),
+                            starting_num_ids,
+                        )
+                    )
+                overlapped_ids.remove(seq_id)
+                out_batch_1.append(sr_1)
+                out_batch_2.append(sr_2)
+                pairs_written += 1
+                if len(out_batch_1) >= batch_size:
+                    put_message(q_out_1, out_batch_1, p_out_1)
+                    put_message(q_out_2, out_batch_2, p_out_2)
+                    out_batch_1 = []
+                    out_batch_2 = []
+            # Drain whatever is left of this file pair so the next pair lines up
+            for _ in srs_r1:
+                pass
+            for _ in srs_r2:
+                pass
+        if out_batch_1:
+            put_message(q_out_1, out_batch_1, p_out_1)
+            put_message(q_out_2, out_batch_2, p_out_2)
+        put_message(q_out_1, None, p_out_1)
+        put_message(q_out_2, None, p_out_2)
+        for p in procs:
+            p.join()
+        for p in (p_out_1, p_out_2):
+            if p.exitcode != 0:
+                raise RuntimeError("{} stage failed with exit code {}".format(p.name, p.exitcode))
+    except BaseException:
+        # Let the write stages close their outputs without a sidecar, rather than kill them mid-write
+        for q_out, p_out in ((q_out_1, p_out_1), (q_out_2, p_out_2)):
+            try:
+                put_message(q_out, ABORT_WRITE, p_out)
+            except RuntimeError:
+                continue
+            p_out.join()
+        # A write stage that died may not have got as far as removing an earlier run's sidecar
+        if sidecar:
+            for path in (out_1_path, out_2_path):
+                if os.path.exists(path + SIDECAR_SUFFIX):
+                    os.remove(path + SIDECAR_SUFFIX)
+        # Nothing will read these queues again, so do not wait on their feeder threads at exit
+        for q in (q_in_1, q_in_2, q_out_1, q_out_2):
+            q.cancel_join_thread()
+        raise
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+    return pairs_written
 
-    assert len(args.in_1) == len(args.in_2), "Mismatched number of forward and reverse read files."
 
+def combine_pairs(in_1, in_2, out_1, out_2, normalize_ids):
+    # Serial merge of open R1 / R2 handles. Returns the number of pairs written.
     # Loop 1: Identify ALL R1 and R2 IDs in all files.
     # Also look for duplicated IDs
     IDs_R1 = set()
     IDs_R2 = set()
     logging.info("Looping through files to identify all sequence IDs")
-    for r1_h, r2_h in zip(args.in_1, args.in_2):
+    for r1_h, r2_h in zip(in_1, in_2):
         # Will not use list comprehension to allow for error handling...
         file_ids_r1 = set()
         r1_reader = fastalite.fastqlite(r1_h)
@@ -93,7 +288,7 @@ def main():
             while True:
                 try:
                     sr = next(r1_reader)
-                    file_ids_r1.add(get_seq_id(sr.id, args.normalize_ids))
+                    file_ids_r1.add(get_seq_id(sr.id, normalize_ids))
                 except ValueError:
                     pass
         except StopIteration:
@@ -105,7 +300,7 @@ def main():
             while True:
                 try:
                     sr = next(r2_reader)
-                    file_ids_r2.add(get_seq_id(sr.id, args.normalize_ids))
+                    file_ids_r2.add(get_seq_id(sr.id, normalize_ids))
                 except ValueError:
                     pass
         except StopIteration:
@@ -134,7 +329,8 @@ def main():
         len(IDs_R2)
     ))
 
-    for r1_h, r2_h in zip(args.in_1, args.in_2):
+    pairs_written = 0
+    for r1_h, r2_h in zip(in_1, in_2):
         srs_r1 = fastalite.fastqlite(r1_h)
         srs_r2 = fastalite.fastqlite(r2_h)
         sr_1 = None
@@ -158,23 +354,24 @@ def main():
                             starting_num_ids,
                         )
                     )
-                while (sr_1 is None) or (get_seq_id(sr_1.id, args.normalize_ids) not in overlapped_ids):
+                while (sr_1 is None) or (get_seq_id(sr_1.id, normalize_ids) not in overlapped_ids):
                     try:
                         sr_1 = next(srs_r1)
                     except ValueError:
                         sr_1 = None
-                while (sr_2 is None) or (get_seq_id(sr_2.id, args.normalize_ids) not in overlapped_ids):
+                while (sr_2 is None) or (get_seq_id(sr_2.id, normalize_ids) not in overlapped_ids):
                     try:
                         sr_2 = next(srs_r2)
                     except ValueError:
                         sr_2 = None
-                assert get_seq_id(sr_1.id, args.normalize_ids) == get_seq_id(sr_2.id, args.normalize_ids), "Order off of reads"
+                assert get_seq_id(sr_1.id, normalize_ids) == get_seq_id(sr_2.id, normalize_ids), "Order off of reads"
                 # Implicit else paired and shared.
                 # Remove it from the target list (takes care of duplicates)
-                overlapped_ids.remove(get_seq_id(sr_1.id, args.normalize_ids))
+                overlapped_ids.remove(get_seq_id(sr_1.id, normalize_ids))
                 # Write out pair...
-                write_fastq(sr_1, args.out_1)
-                write_fastq(sr_2, args.out_2)
+                out_1.write_fastq(sr_1)
+                out_2.write_fastq(sr_2)
+                pairs_written += 1
                 # move to next
                 try:
                     sr_1 = next(srs_r1)
@@ -187,5 +384,428 @@ def main():
         except StopIteration:
             pass
 
+    return pairs_written
+
+
+def read_manifest(manifest_h):
+    #   Manifest is a TSV with a header and columns:
+    #       sample, in_1, in_2, out_1, out_2
+    #   in_1 and in_2 may list several files, comma separated, in matching order.
+    manifest_reader = csv.DictReader(manifest_h, delimiter='\t')
+    missing = {'sample', 'in_1', 'in_2', 'out_1', 'out_2'} - set(manifest_reader.fieldnames or [])
+    if missing:
+        raise ValueError("Manifest is missing column(s): {}".format(", ".join(sorted(missing))))
+    samples = []
+    seen = set()
+    for row in manifest_reader:
+        if not row['sample'] or os.sep in row['sample'] or (os.altsep and os.altsep in row['sample']) \
+                or row['sample'] in {'.', '..'}:
+            raise ValueError("Sample name {!r} cannot be used as a log file name".format(row['sample']))
+        if row['sample'] in seen:
+            raise ValueError("Sample {} is listed more than once in the manifest".format(row['sample']))
+        seen.add(row['sample'])
+        # Short rows leave the missing columns as None
+        empty = [col for col in ('in_1', 'in_2', 'out_1', 'out_2') if not (row[col] or '').strip(' ,')]
+        if empty:
+            raise ValueError("Sample {} has no {} in the manifest".format(row['sample'], ", ".join(empty)))
+        samples.append({
+            'sample': row['sample'],
+            'in_1': [f.strip() for f in row['in_1'].split(',') if f.strip()],
+            'in_2': [f.strip() for f in row['in_2'].split(',') if f.strip()],
+            'out_1': row['out_1'],
+            'out_2': row['out_2'],
+        })
+    return samples
+
+
+def available_cpus():
+    # CPUs this process may run on (e.g. a cluster job's allocation), rather than every CPU of the node
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+
+def write_spill(sr, spill_h):
+    # Spill files keep the full header so records read back unchanged
+    spill_h.write("@{}\n{}\n+\n{}\n".format(sr.description, sr.seq, sr.qual))
+
+
+def combine_pairs_windowed(in_1, in_2, out_1, out_2, normalize_ids, window, overflow='spill'):
+    #   Single pass merge for nearly ordered pairs. Reads not yet matched wait
+    #   in a buffer of up to `window` reads per side; a pair is written as soon
+    #   as both mates are seen. When a buffer overflows, its oldest read is:
+    #       spill: written to a temporary file, and paired up at the end of the file pair
+    #       drop: discarded as if it had no mate
+    #       fail: discarded too, but its mate turning up later is an error
+    #   Unpaired reads are left out, as in the two pass merge. Duplicated IDs
+    #   are only caught while the first copy is still waiting in the buffer.
+    #   Spilled reads, and the index of spilled R1 reads by ID, are kept on disk,
+    #   so memory stays bounded by the window whatever is spilled. fail keeps
+    #   the ID of every read pushed out of the window in memory.
+    pairs_written = 0
+    outs = (out_1, out_2)
+    for r1_h, r2_h in zip(in_1, in_2):
+        pending = (OrderedDict(), OrderedDict())
+        spills = [None, None]
+        # offsets of spilled R1 reads, to find them again by ID (a temporary on-disk database)
+        spill_index = None
+        # IDs of the reads pushed out of each buffer, with overflow fail
+        pushed_out = (set(), set())
+        file_pairs = 0
+        num_spilled = 0
+        num_dropped = 0
+        num_duplicates = 0
+
+        readers = [iter_fastq(r1_h), iter_fastq(r2_h)]
+        # reads taken from each file, and R1 - R2 position of the last pair
+        num_read = [0, 0]
+        drift = 0
+        while readers[0] is not None or readers[1] is not None:
+            # Keep both files at the offset of the last pair found, so
+            # unpaired reads in one file do not push the other out of the window.
+            side = 0 if num_read[0] - num_read[1] <= drift else 1
+            if readers[side] is None:
+                side = 1 - side
+            sr = next(readers[side], None)
+            if sr is None:
+                readers[side] = None
+                continue
+            position = num_read[side]
+            num_read[side] += 1
+            seq_id = get_seq_id(sr.id, normalize_ids)
+            mate = pending[1 - side].pop(seq_id, None)
+            if mate is not None:
+                mate_position, mate = mate
+                if side == 0:
+                    outs[0].write_fastq(sr)
+                    outs[1].write_fastq(mate)
+                    drift = position - mate_position
+                else:
+                    outs[0].write_fastq(mate)
+                    outs[1].write_fastq(sr)
+                    drift = mate_position - position
+                file_pairs += 1
+                continue
+            if seq_id in pushed_out[1 - side]:
+                raise ValueError(
+                    "R{} read {} turned up after its mate was pushed out of the pairing window of {:,} reads. "
+                    "Reads are too far out of order for this window.".format(side + 1, seq_id, window))
+            if seq_id in pending[side]:
+                num_duplicates += 1
+                continue
+            pending[side][seq_id] = (position, sr)
+            if len(pending[side]) <= window:
+                continue
+            # Overflow of the oldest waiting read
+            old_id, (_, old_sr) = pending[side].popitem(last=False)
+            if overflow == 'fail':
+                # Unpaired as far as we know; an error only if its mate still turns up
+                pushed_out[side].add(old_id)
+                num_dropped += 1
+            elif overflow == 'drop':
+                num_dropped += 1
+            else:
+                if spills[side] is None:
+                    spills[side] = tempfile.TemporaryFile(mode='w+')
+                if side == 0:
+                    if spill_index is None:
+                        spill_index = sqlite3.connect('')
+                        spill_index.execute("CREATE TABLE spill (id TEXT PRIMARY KEY, offset INTEGER)")
+                    spill_index.execute(
+                        "INSERT OR IGNORE INTO spill VALUES (?, ?)", (old_id, spills[side].tell()))
+                write_spill(old_sr, spills[side])
+                num_spilled += 1
+
+        # Pair up what is left: waiting / spilled R2 against waiting / spilled R1
+        if num_spilled > 0:
+            leftover_r2 = (sr for _, sr in pending[1].values())
+            if spills[1] is not None:
+                spills[1].seek(0)
+                leftover_r2 = chain(leftover_r2, iter_fastq(spills[1]))
+            for sr_2 in leftover_r2:
+                seq_id = get_seq_id(sr_2.id, normalize_ids)
+                sr_1 = pending[0].pop(seq_id, (None, None))[1]
+                if sr_1 is None and spill_index is not None:
+                    spilled = spill_index.execute("SELECT offset FROM spill WHERE id = ?", (seq_id,)).fetchone()
+                    if spilled is not None:
+                        spill_index.execute("DELETE FROM spill WHERE id = ?", (seq_id,))
+                        spills[0].seek(spilled[0])
+                        sr_1 = next(fastalite.fastqlite([spills[0].readline() for _ in range(4)]))
+                if sr_1 is None:
+                    continue
+                outs[0].write_fastq(sr_1)
+                outs[1].write_fastq(sr_2)
+                file_pairs += 1
+        for spill_h in spills:
+            if spill_h is not None:
+                spill_h.close()
+        if spill_index is not None:
+            spill_index.close()
+
+        logging.info("{:,} pairs written. {:,} reads spilled, {:,} dropped on window overflow, {:,} duplicated IDs skipped".format(
+            file_pairs,
+            num_spilled,
+            num_dropped,
+            num_duplicates
+        ))
+        pairs_written += file_pairs
+    return pairs_written
+
+
+def run_sample(job):
+    #   Pool worker: merge one manifest sample, logging to its own file.
+    #   Any failure is caught and reported so the other samples carry on.
+    sample, normalize_ids, log_dir, sidecar, window, window_overflow = job
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    log_path = os.path.join(log_dir, "{}.log".format(sample['sample']))
+    log_handler = None
+
+    result = {
+        'sample': sample['sample'],
+        'status': 'ok',
+        'pairs': 0,
+        'seconds': 0.0,
+        'error': '',
+        'log': log_path,
+    }
+    start = time.time()
+    handles = []
+    try:
+        log_handler = logging.FileHandler(log_path, mode='w')
+        log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+        root_logger.addHandler(log_handler)
+        root_logger.setLevel(logging.INFO)
+        assert len(sample['in_1']) == len(sample['in_2']), "Mismatched number of forward and reverse read files."
+        in_opener = fastalite.Opener(mode='r')
+        in_1 = [in_opener(f) for f in sample['in_1']]
+        handles += in_1
+        in_2 = [in_opener(f) for f in sample['in_2']]
+        handles += in_2
+        out_1 = OutputWriter(sample['out_1'], 'fastq', sidecar=sidecar)
+        handles.append(out_1)
+        out_2 = OutputWriter(sample['out_2'], 'fastq', sidecar=sidecar)
+        handles.append(out_2)
+        if window is not None:
+            result['pairs'] = combine_pairs_windowed(
+                in_1, in_2, out_1, out_2, normalize_ids, window, window_overflow)
+        else:
+            result['pairs'] = combine_pairs(in_1, in_2, out_1, out_2, normalize_ids)
+        logging.info("Wrote {:,} pairs".format(result['pairs']))
+    except Exception as e:
+        logging.exception("Sample %s failed", sample['sample'])
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+    finally:
+        for h in handles:
+            if result['status'] != 'ok' and isinstance(h, OutputWriter):
+                h.abort()
+            else:
+                h.close()
+        result['seconds'] = round(time.time() - start, 2)
+        if log_handler is not None:
+            log_handler.close()
+    return result
+
+
+def run_manifest(samples, normalize_ids, log_dir, workers, sidecar=False, window=None, window_overflow='spill'):
+    os.makedirs(log_dir, exist_ok=True)
+    jobs = [(sample, normalize_ids, log_dir, sidecar, window, window_overflow) for sample in samples]
+    results = []
+    # One task per child so each sample starts from a clean interpreter state
+    with multiprocessing.Pool(workers, maxtasksperchild=1) as pool:
+        for result in pool.imap_unordered(run_sample, jobs):
+            if result['status'] == 'ok':
+                logging.info("{}: {:,} pairs in {}s".format(
+                    result['sample'], result['pairs'], result['seconds']))
+            else:
+                logging.error("{}: failed ({}). See {}".format(
+                    result['sample'], result['error'], result['log']))
+            results.append(result)
+    # Report in manifest order
+    order = {sample['sample']: i for i, sample in enumerate(samples)}
+    results.sort(key=lambda r: order[r['sample']])
+    return results
+
+
+def main():
+    args_parser = argparse.ArgumentParser(
+        description="""Given set(s) of paired reads in fastq format
+        combine all into one pair of reads also in fastq format.
+        Concurrently confirm all R1 have matched R2.
+        """
+    )
+
+    args_parser.add_argument(
+        '--in-1',
+        '-1',
+        help='Read 1 Files to be combined.',
+        nargs='+',
+        type=fastalite.Opener(mode='r')
+    )
+    args_parser.add_argument(
+        '--in-2',
+        '-2',
+        help="""Read 2 Files to be combined. Must be in same order as --in-1""",
+        nargs='+',
+        type=fastalite.Opener(mode='r')
+    )
+
+    args_parser.add_argument(
+        '--out-1',
+        '-o1',
+        help='File into which we should place our combined R1',
+    )
+    args_parser.add_argument(
+        '--out-2',
+        '-o2',
+        help='File into which we should place our combined R2',
+    )
+
+    args_parser.add_argument(
+        '--normalize-ids',
+        '-ni',
+        help='Normalize IDs for pairs by stripping /x from the end',
+        action='store_true'
+    )
+    args_parser.add_argument(
+        '--sidecar',
+        help='Also write record / base counts and md5 / sha256 of each output to <output>.stats.json',
+        action='store_true'
+    )
+    args_parser.add_argument(
+        '--window',
+        help="""Pair reads in a single pass, holding up to this many unmatched reads
+        per side while waiting for their mates. For files that are only nearly in order.""",
+        type=int
+    )
+    args_parser.add_argument(
+        '--window-overflow',
+        help="""What to do with the oldest unmatched read when the --window fills:
+        spill to a temporary file and pair at the end, drop it, or fail. fail drops
+        it too (an unpaired read), but stops with an error if its mate turns up later,
+        i.e. if the reads are too far out of order (default: %(default)s)""",
+        choices=['spill', 'drop', 'fail'],
+        default='spill'
+    )
+    args_parser.add_argument(
+        '--pipeline',
+        '-p',
+        help="""Run R1 parsing, R2 parsing, pairing and R1 / R2 writing as separate processes.
+        Uses about four cores. Inputs and outputs must be named files.""",
+        action='store_true'
+    )
+    args_parser.add_argument(
+        '--batch-size',
+        help='Records per batch passed between pipeline stages (default: %(default)s)',
+        default=1000,
+        type=int
+    )
+    args_parser.add_argument(
+        '--queue-depth',
+        help='Batches buffered between pipeline stages (default: %(default)s)',
+        default=8,
+        type=int
+    )
+    args_parser.add_argument(
+        '--manifest',
+        '-m',
+        help="""TSV of samples to merge instead of --in-1 / --in-2 / --out-1 / --out-2.
+        Header with columns sample, in_1, in_2, out_1, out_2.
+        Multiple input files per sample are comma separated.""",
+        type=argparse.FileType(mode='r')
+    )
+    args_parser.add_argument(
+        '--workers',
+        '-w',
+        help='Samples to merge at once with --manifest (default: number of CPUs available to this job)',
+        default=available_cpus(),
+        type=int
+    )
+    args_parser.add_argument(
+        '--log-dir',
+        help='Directory for the per-sample logs of --manifest (default: %(default)s)',
+        default='.'
+    )
+    args_parser.add_argument(
+        '--summary',
+        help='Optional TSV summarizing each --manifest sample',
+        type=argparse.FileType('w')
+    )
+
+    args = args_parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.window is not None:
+        if args.window < 1:
+            args_parser.error("--window must be at least 1")
+        if args.pipeline:
+            args_parser.error("--pipeline cannot be combined with --window")
+
+    if args.manifest is not None:
+        if args.pipeline:
+            args_parser.error("--pipeline cannot be combined with --manifest")
+        samples = read_manifest(args.manifest)
+        logging.info("Merging {:,} samples with {} workers".format(len(samples), args.workers))
+        results = run_manifest(
+            samples,
+            args.normalize_ids,
+            args.log_dir,
+            args.workers,
+            sidecar=args.sidecar,
+            window=args.window,
+            window_overflow=args.window_overflow,
+        )
+        if args.summary is not None:
+            summary_writer = csv.DictWriter(
+                args.summary,
+                delimiter='\t',
+                fieldnames=['sample', 'status', 'pairs', 'seconds', 'error', 'log'])
+            summary_writer.writeheader()
+            summary_writer.writerows(results)
+            args.summary.close()
+        failed = [r['sample'] for r in results if r['status'] != 'ok']
+        logging.info("{:,} of {:,} samples merged, {:,} pairs in total".format(
+            len(results) - len(failed),
+            len(results),
+            sum(r['pairs'] for r in results)
+        ))
+        if len(failed) > 0:
+            logging.error("Failed samples: %s" % (", ".join(failed)))
+            sys.exit(-1)
+        return
+
+    if None in (args.in_1, args.in_2, args.out_1, args.out_2):
+        args_parser.error("--in-1, --in-2, --out-1 and --out-2 are required without --manifest")
+
+    assert len(args.in_1) == len(args.in_2), "Mismatched number of forward and reverse read files."
+
+    if args.pipeline:
+        r1_paths = [handle_path(h) for h in args.in_1]
+        r2_paths = [handle_path(h) for h in args.in_2]
+        # The stages open their own handles
+        for h in args.in_1 + args.in_2:
+            h.close()
+        run_pipeline(
+            r1_paths, r2_paths,
+            args.out_1, args.out_2,
+            args.normalize_ids,
+            batch_size=args.batch_size,
+            queue_depth=args.queue_depth,
+            sidecar=args.sidecar,
+        )
+        return
+
+    with OutputWriter(args.out_1, 'fastq', sidecar=args.sidecar) as out_1, \
+            OutputWriter(args.out_2, 'fastq', sidecar=args.sidecar) as out_2:
+        if args.window is not None:
+            combine_pairs_windowed(
+                args.in_1, args.in_2, out_1, out_2, args.normalize_ids, args.window, args.window_overflow)
+        else:
+            combine_pairs(args.in_1, args.in_2, out_1, out_2, args.normalize_ids)
+
+
 if __name__ == "__main__":
     main()
@@ -1,12 +1,32 @@
 #!/usr/bin/env python
 import argparse
-import fastalite
 import logging
+from operator import attrgetter
+from fastatools_io import OutputWriter, read_fasta, seq_key_for
 
 # Given two fasta files, return only those reads in A that are NOT in B.
 # Minimally considers sequence IDs. Can optionally also consider the actual sequences
 
 
+def a_not_b(records_a, records_b, check_seq=False, key=None):
+    # Streaming core: B is read in full, then records of A not in B are yielded as they come.
+    #  key(sr) is what sequences are compared by, sr.seq by default
+    if key is None:
+        key = attrgetter('seq')
+    seq_ids = set()
+    seqs = set()
+    for sr in records_b:
+        seq_ids.add(sr.id)
+        if check_seq:
+            seqs.add(key(sr))
+    for sr in records_a:
+        if sr.id in seq_ids:
+            continue
+        if check_seq and key(sr) in seqs:
+            continue
+        yield sr
+
+
 def main():
     args_parser = argparse.ArgumentParser(
         description="""Given two fasta files, return only those reads in A that are NOT in B.
@@ -35,30 +55,22 @@ def main():
         '-o',
         help='Output file (fasta)',
         required=True,
-        type=argparse.FileType('w')
+    )
+    args_parser.add_argument(
+        '--sidecar',
+        help='Also write record / base counts and md5 / sha256 of the output to <output>.stats.json',
+        action='store_true'
     )
 
     args = args_parser.parse_args()
     logging.basicConfig(level=logging.INFO)
 
-    out_h = args.output
-
-    if args.check_seq:
-        seq_ids = set()
-        seqs = set()
-        for sr in fastalite.fastalite(args.fasta_B):
-            seq_ids.add(sr.id)
-            seqs.add(sr.seq)
-        for sr in fastalite.fastalite(args.fasta_A):
-            if sr.id not in seq_ids and sr.seq not in seqs:
-                out_h.write(">%s %s\n%s\n" % (sr.id, sr.description, sr.seq))
-    else:  # just IDs
-        seq_ids = set()
-        for sr in fastalite.fastalite(args.fasta_B):
-            seq_ids.add(sr.id)
-        for sr in fastalite.fastalite(args.fasta_A):
-            if sr.id not in seq_ids:
-                out_h.write(">%s %s\n%s\n" % (sr.id, sr.description, sr.seq))                    
+    records_a = read_fasta(args.fasta_A)
+    records_b = read_fasta(args.fasta_B)
+    key = seq_key_for([args.fasta_A, args.fasta_B])
+    with OutputWriter(args.output, 'fasta', sidecar=args.sidecar) as out_h:
+        for sr in a_not_b(records_a, records_b, check_seq=args.check_seq, key=key):
+            out_h.write_fasta(sr)
 
 if __name__ == "__main__":
     main()
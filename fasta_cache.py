@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import fastatools_io
+
+# Build (or refresh) the binary sequence cache of fasta files, as <fasta>.2bc.
+# combine_fasta.py, fasta_a_not_b.py, seqs_below_minbest.py and fasta_seq_info.py
+# read a fresh cache in place of its fasta. A cache goes stale, and is ignored,
+# as soon as the fasta changes.
+
+
+def main():
+    args_parser = argparse.ArgumentParser(
+        description="""Build 2-bit packed sequence caches (<fasta>{}) for fasta files
+        that are processed again and again.
+        """.format(fastatools_io.CACHE_SUFFIX)
+    )
+
+    args_parser.add_argument(
+        'fasta',
+        nargs='+',
+        help='Fasta file(s) to cache'
+    )
+    args_parser.add_argument(
+        '--force',
+        '-f',
+        help='Rebuild caches even if they are fresh',
+        action='store_true'
+    )
+
+    args = args_parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    for fasta_path in args.fasta:
+        if not args.force and fastatools_io.cache_is_fresh(fasta_path):
+            logging.info("%s already has a fresh cache" % fasta_path)
+            continue
+        n_records = fastatools_io.write_cache(fasta_path)
+        logging.info("Cached {:,} sequences from {}".format(n_records, fasta_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import functools
+import itertools
+import logging
+import sys
+import fastalite
+from fastatools_io import OutputWriter, read_fasta, run_chain, seq_key_for
+from combine_fasta import combine_records
+from fasta_a_not_b import a_not_b
+from fasta_seq_info import seq_info_header, filter_seq_info
+from seqs_below_minbest import load_best_identities, passed_query_ids, below_minbest
+
+# Run several of the fastatools steps in one process over one stream of records,
+# rather than writing (and re-parsing) an intermediate fasta file between each.
+#
+#   fasta_chain.py -o out.fasta combine a.fasta b.fasta :: a-not-b c.fasta -s :: below-minbest --uc c.uc -m 0.97
+#
+# Steps are separated by '::' and take the same options as the matching script.
+# seq-info, if used, must be the last step and makes the output a csv.
+
+STEP_SEPARATOR = '::'
+
+
+def combine_step(argv, inputs):
+    step_parser = argparse.ArgumentParser(prog='combine', description="Add records from files, skipping repeats (combine_fasta.py)")
+    step_parser.add_argument('files', nargs='+', type=fastalite.Opener(mode='r'))
+    step_parser.add_argument('--fastq', '-q', action='store_true')
+    step_parser.add_argument('--check-seq', '-s', action='store_true')
+    step_args = step_parser.parse_args(argv)
+
+    if step_args.fastq:
+        readers = [fastalite.fastqlite(file_h) for file_h in step_args.files]
+        key = None
+    else:
+        readers = [read_fasta(file_h) for file_h in step_args.files]
+        # Any records from earlier steps come from earlier inputs
+        key = seq_key_for(inputs + step_args.files)
+    inputs.extend(step_args.files)
+
+    def step(records):
+        return combine_records(itertools.chain(records, *readers), check_seq=step_args.check_seq, key=key)
+    return step, step_args.fastq
+
+
+def a_not_b_step(argv, inputs):
+    step_parser = argparse.ArgumentParser(prog='a-not-b', description="Drop records found in fasta B (fasta_a_not_b.py)")
+    step_parser.add_argument('fasta_B', type=fastalite.Opener(mode='r'))
+    step_parser.add_argument('--check-seq', '-s', action='store_true')
+    step_args = step_parser.parse_args(argv)
+
+    # The records reaching this step all come from the files of the combine steps before it
+    key = seq_key_for(inputs + [step_args.fasta_B])
+
+    def step(records):
+        return a_not_b(records, read_fasta(step_args.fasta_B), check_seq=step_args.check_seq, key=key)
+    return step, False
+
+
+def below_minbest_step(argv, inputs):
+    step_parser = argparse.ArgumentParser(prog='below-minbest', description="Keep records without a hit at min best (seqs_below_minbest.py)")
+    step_parser.add_argument('--uc', nargs='+', default=[], type=argparse.FileType(mode='r'))
+    step_parser.add_argument('--blast6', nargs='+', default=[], type=argparse.FileType(mode='r'))
+    step_parser.add_argument('--userout', nargs='+', default=[], type=argparse.FileType(mode='r'))
+    step_parser.add_argument('--userfields', default='query+target+id')
+    step_parser.add_argument('--min-best', '-m', required=True, type=float)
+    step_args = step_parser.parse_args(argv)
+    if len(step_args.uc) + len(step_args.blast6) + len(step_args.userout) == 0:
+        step_parser.error("At least one of --uc, --blast6 or --userout is required")
+
+    def step(records):
+        best = load_best_identities(step_args.uc, step_args.blast6, step_args.userout, step_args.userfields)
+        query_ids, passed_queries = passed_query_ids(best, step_args.min_best)
+        return below_minbest(records, query_ids, passed_queries)
+    return step, False
+
+
+def seq_info_step(argv, inputs):
+    step_parser = argparse.ArgumentParser(prog='seq-info', description="Sequence information rows for the records (fasta_seq_info.py)")
+    step_parser.add_argument('--sequence-info', '-si', nargs='+', required=True, type=argparse.FileType(mode='r'))
+    step_args = step_parser.parse_args(argv)
+
+    seq_info_readers = [csv.DictReader(seq_info_h) for seq_info_h in step_args.sequence_info]
+    step = functools.partial(filter_seq_info, seq_info_readers=seq_info_readers)
+    step.header = seq_info_header(seq_info_readers)
+    return step, False
+
+
+STEPS = {
+    'combine': combine_step,
+    'a-not-b': a_not_b_step,
+    'below-minbest': below_minbest_step,
+    'seq-info': seq_info_step,
+}
+
+
+def split_steps(argv):
+    steps = []
+    for is_sep, step_argv in itertools.groupby(argv, lambda a: a == STEP_SEPARATOR):
+        if not is_sep:
+            steps.append(list(step_argv))
+    return steps
+
+
+def main():
+    args_parser = argparse.ArgumentParser(
+        description="""Chain fastatools steps over one stream of records in one process.
+        Steps ({}) are separated by '{}'. The first step must be combine.
+        """.format(", ".join(STEPS), STEP_SEPARATOR)
+    )
+    args_parser.add_argument(
+        '--output',
+        '-o',
+        help='Output file. fasta (or fastq from combine --fastq), or csv when the last step is seq-info',
+        required=True,
+    )
+    args_parser.add_argument(
+        '--sidecar',
+        help='Also write record / base counts and md5 / sha256 of the output to <output>.stats.json',
+        action='store_true'
+    )
+    args_parser.add_argument(
+        'steps',
+        help='Steps and their options',
+        nargs=argparse.REMAINDER
+    )
+
+    args = args_parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    step_argvs = split_steps(args.steps)
+    if len(step_argvs) == 0 or step_argvs[0][0] != 'combine':
+        args_parser.error("The first step must be combine")
+    for n, step_argv in enumerate(step_argvs):
+        if step_argv[0] not in STEPS:
+            args_parser.error("Unknown step {}. Choose from {}".format(step_argv[0], ", ".join(STEPS)))
+        if step_argv[0] == 'seq-info' and n != len(step_argvs) - 1:
+            args_parser.error("seq-info must be the last step")
+
+    steps = []
+    fastq = False
+    # Files read by the steps so far
+    inputs = []
+    for step_argv in step_argvs:
+        step, step_fastq = STEPS[step_argv[0]](step_argv[1:], inputs)
+        fastq = fastq or step_fastq
+        steps.append(step)
+
+    results = run_chain([], steps)
+
+    if step_argvs[-1][0] == 'seq-info':
+        if 'seqname' not in steps[-1].header:
+            logging.error("No seqname column found in the seqinfo files. Cannot filter")
+            sys.exit(-1)
+        with OutputWriter(args.output, 'csv', sidecar=args.sidecar) as out_h:
+            si_writer = csv.DictWriter(out_h, fieldnames=steps[-1].header)
+            si_writer.writeheader()
+            try:
+                for row in results:
+                    si_writer.writerow(row)
+                    out_h.count_record()
+            except ValueError:
+                # Leaving the with block through sys.exit aborts the output
+                sys.exit(-1)
+    else:
+        with OutputWriter(args.output, 'fastq' if fastq else 'fasta', sidecar=args.sidecar) as out_h:
+            for sr in results:
+                if fastq:
+                    out_h.write_fastq(sr)
+                else:
+                    out_h.write_fasta(sr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,56 @@
 #!/usr/bin/env python
 import argparse
-import fastalite
 import csv
+import itertools
 import logging
 import sys
+from fastatools_io import OutputWriter, read_fasta
 
 # Given a FASTA file(s) and sequence information csv file(s),
 # filter the sequence information to only include rows for reads in the fasta file(s).
 
 
+def seq_info_header(seq_info_readers):
+    #  Figure out the union of headers for all of these seq info files
+    out_si_header = []
+    for si_r in seq_info_readers:
+        # Try to preserve order, only appending missing fn
+        for fn in si_r.fieldnames:
+            if fn not in out_si_header:
+                out_si_header.append(fn)
+    return out_si_header
+
+
+def filter_seq_info(records, seq_info_readers):
+    #   Streaming core: yield the seq info rows for the sequence records.
+    #   Raises ValueError, after yielding every row found, if any record had no row.
+
+    # Load all the seq_ids into a set
+    seq_ids = set()
+    for sr in records:
+        seq_ids.add(sr.id)
+
+    logging.info("Found %d unique sequence IDs" % len(seq_ids))
+
+    # Now go through each sequence information file. See if the row matches one of our target ids.
+    for si_r in seq_info_readers:
+        for row in si_r:
+            if row['seqname'] in seq_ids:
+                yield row
+                seq_ids.remove(row['seqname'])
+        # No need to continue if we have no seq ids to find
+            if len(seq_ids) == 0:
+                break
+        if len(seq_ids) == 0:
+                break
+
+    # we should have found all of our seq IDs by now. Therefore express concern if we haven't
+
+    if len(seq_ids) > 0:
+        logging.error("Could not find sequence information for sequences in the FASTA file with IDs: %s" % (", ".join(seq_ids)))
+        raise ValueError("No sequence information for {:,} sequence IDs".format(len(seq_ids)))
+
+
 def main():
     args_parser = argparse.ArgumentParser(
         description="""Given a FASTA file(s) and sequence information csv file(s)
@@ -35,7 +77,11 @@ def main():
         '-o',
         help='File into which we should place our filtered sequence information',
         required=True,
-        type=argparse.FileType('w')
+    )
+    args_parser.add_argument(
+        '--sidecar',
+        help='Also write row count and md5 / sha256 of the output to <output>.stats.json',
+        action='store_true'
     )
 
     args = args_parser.parse_args()
@@ -46,13 +92,7 @@ def main():
         csv.DictReader(seq_info_h) for seq_info_h in args.sequence_info
     ]
 
-    #  Figure out the union of headers for all of these seq info files
-    out_si_header = []
-    for si_r in seq_info_readers:
-        # Try to preserve order, only appending missing fn
-        for fn in si_r.fieldnames:
-            if fn not in out_si_header:
-                out_si_header.append(fn)
+    out_si_header = seq_info_header(seq_info_readers)
 
     # We should at least have a seqname column in at least one seqinfo file.
     # If not, error and quit.
@@ -61,37 +101,20 @@ def main():
         sys.exit(-1)
 
     # Implicit else...
-    out_h = args.output
-    si_writer = csv.DictWriter(
-        out_h,
-        fieldnames=out_si_header)
-    si_writer.writeheader()
-
-    # Load all the seq_ids into a set
-    seq_ids = set()
-    for fasta_h in args.fasta:
-        for sr in fastalite.fastalite(fasta_h):
-            seq_ids.add(sr.id)
-
-    logging.info("Found %d unique sequence IDs" % len(seq_ids))
+    with OutputWriter(args.output, 'csv', sidecar=args.sidecar) as out_h:
+        si_writer = csv.DictWriter(
+            out_h,
+            fieldnames=out_si_header)
+        si_writer.writeheader()
 
-    # Now go through each sequence information file. See if the row matches one of our target ids.
-    for si_r in seq_info_readers:
-        for row in si_r:
-            if row['seqname'] in seq_ids:
+        try:
+            for row in filter_seq_info(itertools.chain.from_iterable(
+                    read_fasta(fasta_h) for fasta_h in args.fasta), seq_info_readers):
                 si_writer.writerow(row)
-                seq_ids.remove(row['seqname'])
-        # No need to continue if we have no seq ids to find
-            if len(seq_ids) == 0:
-                break
-        if len(seq_ids) == 0:
-                break
-
-    # we should have found all of our seq IDs by now. Therefore express concern if we haven't
-
-    if len(seq_ids) > 0:
-        logging.error("Could not find sequence information for sequences in the FASTA file with IDs: %s" % (", ".join(seq_ids)))
-        sys.exit(-1)
+                out_h.count_record()
+        except ValueError:
+            # Leaving the with block through sys.exit aborts the output
+            sys.exit(-1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,364 @@
+import bz2
+import gzip
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import fastalite
+
+# Shared input / output helpers for the fastatools scripts.
+#
+#   OutputWriter: write fasta / fastq (or any text) to a file, optionally gzip or bz2
+#   compressed by suffix, counting records and bases and computing md5 / sha256
+#   digests of both the written file and its uncompressed content as it goes.
+#   The results can be written to a <output>.stats.json sidecar on close,
+#   so no second pass over the output is needed to validate it.
+#
+#   Sequence cache: a binary <fasta>.2bc next to a fasta file, with sequences
+#   packed 2 bits per base (exceptions for N / IUPAC codes and runs of lowercase
+#   kept separately), a header table and an offset index. read_fasta() uses a
+#   fresh cache in place of the fasta. When every input is cached, the packed
+#   form (seq_key) is what the tools compare when checking for repeated
+#   sequences; text inputs compare the plain sequence strings, as packing
+#   them costs more than it saves.
+#
+#   run_chain: thread one stream of records through the streaming cores of the
+#   tools (combine_records, a_not_b, below_minbest, ...) without intermediate files.
+
+SIDECAR_SUFFIX = '.stats.json'
+BUFFER_SIZE = 1 << 16
+
+CACHE_SUFFIX = '.2bc'
+CACHE_MAGIC = b'FTC2'
+CACHE_VERSION = 1
+# magic, version, records, source size, source mtime (ns), header table offset, index offset
+CACHE_HEADER = struct.Struct('<4sIQQqQQ')
+# packed sequence offset, packed sequence length, header offset, header length
+CACHE_INDEX = struct.Struct('<QQQI')
+
+# packed sequence: length, exception runs, lowercase runs; then the 2-bit bases
+PACKED_HEADER = struct.Struct('<QII')
+# exception run: start, length, character
+PACKED_EXCEPTION = struct.Struct('<QIB')
+# lowercase run: start, length
+PACKED_MASK = struct.Struct('<QI')
+
+BASE_TO_DIGIT = str.maketrans('ACGT', '0123')
+# BYTE_TO_BASE[k] maps a packed byte to its k-th base, so unpacking is 4 bytes.translate calls
+BYTE_TO_BASE = [bytes(b'ACGT'[(i >> (6 - 2 * k)) & 3] for i in range(256)) for k in range(4)]
+RE_EXCEPTION = re.compile(r'([^ACGT])\1*')
+RE_NOT_ACGT = re.compile(r'[^ACGT]')
+RE_LOWER = re.compile(r'[a-z]+')
+
+
+def pack_seq(seq):
+    # 2-bit packed form of seq. Identical sequences always pack to identical bytes.
+    upper = seq.upper()
+    exceptions = [
+        PACKED_EXCEPTION.pack(m.start(), m.end() - m.start(), ord(m.group(1)))
+        for m in RE_EXCEPTION.finditer(upper)
+    ]
+    mask = [PACKED_MASK.pack(m.start(), m.end() - m.start()) for m in RE_LOWER.finditer(seq)]
+    if exceptions:
+        upper = RE_NOT_ACGT.sub('A', upper)
+    n_bytes = (len(seq) + 3) // 4
+    if n_bytes > 0:
+        digits = upper.translate(BASE_TO_DIGIT) + '0' * (n_bytes * 4 - len(seq))
+        packed = int(digits, 4).to_bytes(n_bytes, 'big')
+    else:
+        packed = b''
+    return b''.join([PACKED_HEADER.pack(len(seq), len(exceptions), len(mask)), packed] + exceptions + mask)
+
+
+def unpack_seq(key):
+    seq_len, n_exceptions, n_mask = PACKED_HEADER.unpack_from(key)
+    pos = PACKED_HEADER.size
+    n_bytes = (seq_len + 3) // 4
+    packed = key[pos:pos + n_bytes]
+    seq_b = bytearray(n_bytes * 4)
+    seq_b[0::4] = packed.translate(BYTE_TO_BASE[0])
+    seq_b[1::4] = packed.translate(BYTE_TO_BASE[1])
+    seq_b[2::4] = packed.translate(BYTE_TO_BASE[2])
+    seq_b[3::4] = packed.translate(BYTE_TO_BASE[3])
+    del seq_b[seq_len:]
+    if n_exceptions == 0 and n_mask == 0:
+        return seq_b.decode('ascii')
+    pos += n_bytes
+    for start, length, c in PACKED_EXCEPTION.iter_unpack(key[pos:pos + n_exceptions * PACKED_EXCEPTION.size]):
+        seq_b[start:start + length] = bytes([c]) * length
+    pos += n_exceptions * PACKED_EXCEPTION.size
+    for start, length in PACKED_MASK.iter_unpack(key[pos:pos + n_mask * PACKED_MASK.size]):
+        seq_b[start:start + length] = seq_b[start:start + length].lower()
+    return seq_b.decode('ascii')
+
+
+class CachedRecord(object):
+    # Record read from a sequence cache. The sequence is only unpacked if .seq is used.
+    __slots__ = ('id', 'description', 'seq_key')
+
+    def __init__(self, description, seq_key):
+        self.id = description.split()[0]
+        self.description = description
+        self.seq_key = seq_key
+
+    @property
+    def seq(self):
+        return unpack_seq(self.seq_key)
+
+
+def seq_key(sr):
+    # Compact, comparable form of a record's sequence
+    key = getattr(sr, 'seq_key', None)
+    if key is None:
+        key = pack_seq(sr.seq)
+    return key
+
+
+def cache_path(fasta_path):
+    return fasta_path + CACHE_SUFFIX
+
+
+def read_cache_header(path):
+    with open(path, 'rb') as cache_h:
+        header = CACHE_HEADER.unpack(cache_h.read(CACHE_HEADER.size))
+    if header[0] != CACHE_MAGIC or header[1] != CACHE_VERSION:
+        raise ValueError("{} is not a version {} sequence cache".format(path, CACHE_VERSION))
+    return header
+
+
+def cache_is_fresh(fasta_path):
+    # A cache is fresh if it was built from a fasta of this size and modification time
+    try:
+        fasta_stat = os.stat(fasta_path)
+        header = read_cache_header(cache_path(fasta_path))
+    except (OSError, ValueError, struct.error):
+        return False
+    return header[3] == fasta_stat.st_size and header[4] == fasta_stat.st_mtime_ns
+
+
+def write_cache(fasta_path):
+    fasta_stat = os.stat(fasta_path)
+    tmp_path = cache_path(fasta_path) + '.tmp'
+    descriptions = []
+    index = []
+    with open(tmp_path, 'wb') as cache_h:
+        cache_h.write(b'\0' * CACHE_HEADER.size)
+        offset = CACHE_HEADER.size
+        with fastalite.Opener(mode='r')(fasta_path) as fasta_h:
+            for sr in fastalite.fastalite(fasta_h):
+                key = pack_seq(sr.seq)
+                cache_h.write(key)
+                index.append((offset, len(key)))
+                descriptions.append(sr.description.encode('utf-8'))
+                offset += len(key)
+        header_table_offset = offset
+        for description in descriptions:
+            cache_h.write(description)
+        index_offset = header_table_offset + sum(len(d) for d in descriptions)
+        header_offset = header_table_offset
+        for (key_offset, key_len), description in zip(index, descriptions):
+            cache_h.write(CACHE_INDEX.pack(key_offset, key_len, header_offset, len(description)))
+            header_offset += len(description)
+        cache_h.seek(0)
+        cache_h.write(CACHE_HEADER.pack(
+            CACHE_MAGIC,
+            CACHE_VERSION,
+            len(index),
+            fasta_stat.st_size,
+            fasta_stat.st_mtime_ns,
+            header_table_offset,
+            index_offset,
+        ))
+    os.replace(tmp_path, cache_path(fasta_path))
+    return len(index)
+
+
+def read_cache(path):
+    # Yield the CachedRecords of a sequence cache, in the order of the original fasta
+    with open(path, 'rb') as cache_h:
+        if os.fstat(cache_h.fileno()).st_size == 0:
+            raise ValueError("{} is not a version {} sequence cache".format(path, CACHE_VERSION))
+        with mmap.mmap(cache_h.fileno(), 0, access=mmap.ACCESS_READ) as cache_mm:
+            magic, version, n_records, _, _, _, index_offset = CACHE_HEADER.unpack_from(cache_mm)
+            if magic != CACHE_MAGIC or version != CACHE_VERSION:
+                raise ValueError("{} is not a version {} sequence cache".format(path, CACHE_VERSION))
+            for i in range(n_records):
+                key_offset, key_len, header_offset, header_len = CACHE_INDEX.unpack_from(
+                    cache_mm, index_offset + i * CACHE_INDEX.size)
+                yield CachedRecord(
+                    cache_mm[header_offset:header_offset + header_len].decode('utf-8'),
+                    cache_mm[key_offset:key_offset + key_len]
+                )
+
+
+def has_fresh_cache(fasta_h):
+    path = getattr(fasta_h, 'name', None)
+    return isinstance(path, str) and cache_is_fresh(path)
+
+
+def read_fasta(fasta_h):
+    # fastalite.fastalite(fasta_h), from the fasta's sequence cache if there is a fresh one
+    if has_fresh_cache(fasta_h):
+        logging.info("Reading %s from its sequence cache", fasta_h.name)
+        return read_cache(cache_path(fasta_h.name))
+    return fastalite.fastalite(fasta_h)
+
+
+def seq_key_for(fasta_hs):
+    # seq_key when every fasta is read from its cache, else None (compare plain sequences)
+    if all(has_fresh_cache(fasta_h) for fasta_h in fasta_hs):
+        return seq_key
+    return None
+
+
+def run_chain(records, steps):
+    # Each step takes an iterable of records and returns (or yields) another
+    for step in steps:
+        records = step(records)
+    return records
+
+
+class DigestingFile(object):
+    # Binary file-like that digests everything written through it to raw_h
+
+    def __init__(self, raw_h, digests=True):
+        self.raw_h = raw_h
+        self.num_bytes = 0
+        self.hashes = [hashlib.md5(), hashlib.sha256()] if digests else []
+
+    def write(self, data):
+        self.num_bytes += len(data)
+        for h in self.hashes:
+            h.update(data)
+        return self.raw_h.write(data)
+
+    def flush(self):
+        self.raw_h.flush()
+
+    def summary(self):
+        summary = {'bytes': self.num_bytes}
+        for h in self.hashes:
+            summary[h.name] = h.hexdigest()
+        return summary
+
+
+class OutputWriter(object):
+    """Text output that keeps record / base counts and digests while writing.
+
+    ``path`` may end in .gz or .bz2 for compressed output, or be '-' for stdout.
+    With ``sidecar=True`` the counts and md5 / sha256 of the file and of its
+    uncompressed content are written to ``path + SIDECAR_SUFFIX`` on close.
+    Any sidecar from an earlier run is removed on opening, so a sidecar only
+    exists after a successful close().
+    """
+
+    def __init__(self, path, file_format='fasta', sidecar=False):
+        self.path = path
+        self.file_format = file_format
+        self.sidecar = sidecar
+        self.records = 0
+        self.bases = 0
+        self.closed = False
+        self._buffer = []
+        self._buffered = 0
+
+        if path == '-':
+            if sidecar:
+                raise ValueError("Cannot write a stats sidecar for output to stdout")
+            self._raw_h = sys.stdout.buffer
+        else:
+            if sidecar and os.path.exists(path + SIDECAR_SUFFIX):
+                os.remove(path + SIDECAR_SUFFIX)
+            self._raw_h = open(path, 'wb')
+        suffix = path.rsplit('.', 1)[-1]
+        if suffix in {'gz', 'bz2'}:
+            self._file = DigestingFile(self._raw_h, digests=sidecar)
+            if suffix == 'gz':
+                self._compressed_h = gzip.GzipFile(
+                    filename=os.path.basename(path)[:-3], mode='wb', fileobj=self._file)
+            else:
+                self._compressed_h = bz2.BZ2File(self._file, mode='wb')
+            self._content = DigestingFile(self._compressed_h, digests=sidecar)
+        else:
+            self._file = None
+            self._compressed_h = None
+            self._content = DigestingFile(self._raw_h, digests=sidecar)
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._content.write(''.join(self._buffer).encode('utf-8'))
+            self._buffer = []
+            self._buffered = 0
+
+    def count_record(self, bases=0):
+        # For formats (e.g. csv) written with write() directly
+        self.records += 1
+        self.bases += bases
+
+    def write_fasta(self, sr):
+        # sr.seq of a cached record unpacks on every access, so take it once
+        seq = sr.seq
+        self.write(">%s %s\n%s\n" % (sr.id, sr.description, seq))
+        self.count_record(len(seq))
+
+    def write_fastq(self, sr):
+        self.write("@{} {}\n{}\n+\n{}\n".format(
+            sr.id,
+            sr.description,
+            sr.seq,
+            sr.qual
+        ))
+        self.count_record(len(sr.seq))
+
+    def stats(self):
+        content = self._content.summary()
+        return {
+            'path': self.path,
+            'format': self.file_format,
+            'records': self.records,
+            'bases': self.bases,
+            'file': self._file.summary() if self._file is not None else content,
+            'content': content,
+        }
+
+    def close(self):
+        self._close(write_sidecar=self.sidecar)
+
+    def abort(self):
+        # Close after a failed run, without writing a sidecar
+        self._close(write_sidecar=False)
+
+    def _close(self, write_sidecar):
+        if self.closed:
+            return
+        self.flush()
+        if self._compressed_h is not None:
+            self._compressed_h.close()
+        if self._raw_h is sys.stdout.buffer:
+            self._raw_h.flush()
+        else:
+            self._raw_h.close()
+        self.closed = True
+        if write_sidecar:
+            with open(self.path + SIDECAR_SUFFIX, 'w') as sidecar_h:
+                json.dump(self.stats(), sidecar_h, indent=2)
+                sidecar_h.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is not None:
+            self.abort()
+        else:
+            self.close()
@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 import argparse
-import fastalite
 import logging
 import csv
+from fastatools_io import OutputWriter, read_fasta
 
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# Rows per chunk when reading search results with pandas
+CHUNK_ROWS = 1000000
 
 # UC Format for searching. TSV
 # 0. Record type: H, or N. H= Hit. N= No hit
@@ -16,29 +23,139 @@ import csv
 # 7. Compact representation of the pairwise alignment using the CIGAR for- mat (Compact Idiosyncratic Gapped Alignment Report): M (match), D (deletion) and I (insertion). The equal sign ?=? indicates that the query is identical to the centroid sequence. Set to ?*? for N.
 # 8. Label of the query sequence.
 # 9. Label of the target centroid sequence. Set to ?*? for N.
+#
+# Also accepted: BLAST tabular (-outfmt 6 / m8), where column 0 is the query, 1 the subject
+# and 2 the percent identity; and vsearch --userout, with the columns given by --userfields
+# (query and id required; no-hit rows from --output_no_hits have a target of *).
+#
+# Only the query, hit and percent identity columns are used. They are folded as they are
+# read into the best percent identity per query, so the whole file is never held in memory.
+# If pandas is installed the results are parsed in vectorized chunks of those columns only.
+
+
+def best_identities(results_h, query_col, id_col, best, hit_col=None, hit_code=None):
+    #   Fold tab separated search results into best: query id -> best percent identity
+    #   (None for queries with no hit). A row is a hit unless hit_col is '*', or, when
+    #   hit_code is given, unless hit_col is hit_code. Returns the number of rows read.
+    if pd is not None:
+        return best_identities_chunked(results_h, query_col, id_col, best, hit_col, hit_code)
+    rows = 0
+    for row in csv.reader(results_h, delimiter='\t', quoting=csv.QUOTE_NONE):
+        if not row:
+            # Blank lines, which pandas skips too
+            continue
+        rows += 1
+        query_id = row[query_col]
+        if hit_col is not None and (row[hit_col] != hit_code if hit_code is not None else row[hit_col] == '*'):
+            if query_id not in best:
+                best[query_id] = None
+            continue
+        percent_id = float(row[id_col])
+        prev = best.get(query_id)
+        if prev is None or percent_id > prev:
+            best[query_id] = percent_id
+    return rows
+
+
+def best_identities_chunked(results_h, query_col, id_col, best, hit_col=None, hit_code=None):
+    # best_identities, reading only the needed columns in typed chunks with pandas
+    usecols = sorted({query_col, id_col} | ({hit_col} if hit_col is not None else set()))
+    try:
+        chunks = pd.read_csv(
+            results_h,
+            sep='\t',
+            header=None,
+            usecols=usecols,
+            dtype={col: (float if col == id_col else str) for col in usecols},
+            na_values={id_col: ['*']},
+            keep_default_na=False,
+            quoting=csv.QUOTE_NONE,
+            chunksize=CHUNK_ROWS,
+        )
+    except pd.errors.EmptyDataError:
+        return 0
+    rows = 0
+    chunk_bests = []
+    no_hit_ids = []
+    for chunk in chunks:
+        rows += len(chunk)
+        if hit_col is not None:
+            if hit_code is not None:
+                hits = chunk[hit_col] == hit_code
+            else:
+                hits = chunk[hit_col] != '*'
+            no_hit_ids.append(chunk.loc[~hits, query_col].unique())
+            chunk = chunk[hits]
+        chunk_bests.append(chunk[id_col].groupby(chunk[query_col], sort=False).max())
+    if len(chunk_bests) == 0:
+        return rows
+
+    file_best = pd.concat(chunk_bests).groupby(level=0, sort=False).max()
+    if len(best) == 0:
+        best.update(file_best.to_dict())
+    else:
+        for query_id, percent_id in file_best.items():
+            prev = best.get(query_id)
+            if prev is None or percent_id > prev:
+                best[query_id] = percent_id
+    for query_ids in no_hit_ids:
+        for query_id in query_ids:
+            if query_id not in best:
+                best[query_id] = None
+    return rows
+
+
+def load_best_identities(uc=(), blast6=(), userout=(), userfields='query+target+id'):
+    # Best percent identity per query across all the search result files
+    best = {}
+    rows = 0
+    for uc_h in uc:
+        rows += best_identities(uc_h, 8, 3, best, hit_col=0, hit_code='H')
+    for blast6_h in blast6:
+        rows += best_identities(blast6_h, 0, 2, best)
+    if len(userout) > 0:
+        fields = userfields.split('+')
+        if 'query' not in fields or 'id' not in fields:
+            raise ValueError("--userfields must include query and id, not {}".format(userfields))
+        target_col = fields.index('target') if 'target' in fields else None
+        for userout_h in userout:
+            rows += best_identities(userout_h, fields.index('query'), fields.index('id'), best, hit_col=target_col)
+    logging.info("%d query result rows read in from the search result file(s)" % rows)
+    return best
+
+
+def passed_query_ids(best, min_best):
+    # Returns (all query ids searched, query ids with a hit >= min_best)
+    query_ids = best.keys()
+    logging.info("%d unique query_ids searched." % len(query_ids))
+
+    # passed_queries: query sequence ids with a hit >= minbest
+    passed_queries = {
+        query_id for query_id, percent_id in best.items()
+        if percent_id is not None and percent_id / 100.0 >= min_best
+    }
 
-def read_uc(uc_h):
-    uc_reader = csv.DictReader(
-        uc_h,
-        delimiter='\t',
-        fieldnames=[
-            'result_code',
-            'target_n',
-            'seq_len',
-            'percent_id',
-            'match_orientation',
-            'r5',
-            'r6',
-            'cigar',
-            'query_id',
-            'target_id',
-        ])
-    return [r for r in uc_reader]
+    logging.info("{} query_ids had a best hit meeting our threshold of {}.".format(
+        len(passed_queries),
+        min_best
+    ))
+    return query_ids, passed_queries
+
+
+def below_minbest(records, query_ids, passed_queries):
+    # Streaming core: yield the query records without a hit meeting min best
+    for sr in records:
+        if sr.id in passed_queries:  # If we are in our passed queries, leave it out.
+            continue
+        # Implicit else
+        if sr.id not in query_ids:
+            logging.warning("%s was in the input query fasta but had no entry in the search results. Included in the output" % sr.id)
+        yield sr
 
 
 def main():
     args_parser = argparse.ArgumentParser(
-        description="""Filters sequences whose best search results (uc format) falls below a minimum
+        description="""Filters sequences whose best search results (uc, blast6 or vsearch userout) falls below a minimum
         percent sequence identity.
         """)
 
@@ -52,7 +169,26 @@ def main():
         nargs='+',
         help='UC files(s) with search results for these queries',
         type=argparse.FileType(mode='r'),
-        required=True
+        default=[]
+    )
+    args_parser.add_argument(
+        '--blast6',
+        nargs='+',
+        help='BLAST tabular (-outfmt 6 / m8) file(s) with search results for these queries',
+        type=argparse.FileType(mode='r'),
+        default=[]
+    )
+    args_parser.add_argument(
+        '--userout',
+        nargs='+',
+        help='vsearch --userout file(s) with search results for these queries',
+        type=argparse.FileType(mode='r'),
+        default=[]
+    )
+    args_parser.add_argument(
+        '--userfields',
+        help='The vsearch --userfields used for the --userout files (default: %(default)s)',
+        default='query+target+id'
     )
     args_parser.add_argument(
         '--min-best',
@@ -69,54 +205,28 @@ def main():
         help="""FASTA file into which we should place
         our query sequences without a hit above minbest""",
         required=True,
-        type=argparse.FileType('w')
+    )
+    args_parser.add_argument(
+        '--sidecar',
+        help='Also write record / base counts and md5 / sha256 of the output to <output>.stats.json',
+        action='store_true'
     )
 
     args = args_parser.parse_args()
     logging.basicConfig(level=logging.INFO)
 
-    min_best = float(args.min_best)
-    out_h = args.output
-
-    all_uc_data = []
-    uc_h = args.uc
-
-    for uc in uc_h:
-        all_uc_data += read_uc(uc)
-
-    logging.info("%d query result rows read in from the UC file(s)" % len(all_uc_data))
-
-    # passed_queries: query sequence ids with a hit >= minbest
-    passed_queries = set()
+    if len(args.uc) + len(args.blast6) + len(args.userout) == 0:
+        args_parser.error("At least one of --uc, --blast6 or --userout is required")
 
-    # Get the queries
-    query_ids = {r['query_id'] for r in all_uc_data}
-    logging.info("%d unique query_ids searched." % len(query_ids))
+    min_best = float(args.min_best)
+    with OutputWriter(args.output, 'fasta', sidecar=args.sidecar) as out_h:
+        best = load_best_identities(args.uc, args.blast6, args.userout, args.userfields)
 
-    # For each query...
-    for query_id in query_ids:
-        # Grab rows where we have a hit
-        query_hits = [
-            r for r in all_uc_data
-            if r['query_id'] == query_id if r['result_code'] == 'H'
-        ]
-        if len(query_hits) == 0:  # No hits for this query.
-            continue
-        if max([float(r['percent_id']) / 100.0 for r in query_hits]) >= min_best:
-            passed_queries.add(query_id)
+        query_ids, passed_queries = passed_query_ids(best, min_best)
 
-    logging.info("{} query_ids had a best hit meeting our threshold of {}.".format(
-        len(passed_queries),
-        min_best
-    ))
+        for sr in below_minbest(read_fasta(args.query_fasta), query_ids, passed_queries):
+            out_h.write_fasta(sr)
 
-    for sr in fastalite.fastalite(args.query_fasta):
-        if sr.id in passed_queries:  # If we are in our passed queries, leave it out.
-            continue
-        # Implicit else
-        if sr.id not in query_ids:
-            logging.warn("%s was in the input query fasta but had no entry in the UC files. Included in the output" % sr.id)
-        out_h.write(">%s %s\n%s\n" % (sr.id, sr.description, sr.seq))
 
 if __name__ == "__main__":
     main()